@@ -1,24 +1,34 @@
 from flask import Flask, request, jsonify
+import click
 from flask_cors import CORS
-from pymongo import MongoClient
+from pymongo import WriteConcern
+from pymongo.errors import DuplicateKeyError
+from bson import ObjectId
 import bcrypt
 import jwt
 import datetime
 import os
+import sys
 from dotenv import load_dotenv
 from auth import token_required
+from database import db
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectTimeoutError, ReadTimeoutError
 from flask import send_file, Response
 from werkzeug.utils import secure_filename
 import requests
-from utils import get_bucket_url
-from mongo_handler import MongoDBHandler
+from utils import get_bucket_url, get_username_prefix
+from mongo_handler import add_mongo_handler
+from orjson_provider import OrjsonProvider
 import logging
+import base64
 
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Enable CORS
 CORS(app, supports_credentials=True)
@@ -27,23 +37,96 @@ CORS(app, supports_credentials=True)
 app.config["MONGO_URI"] = os.getenv('MONGO_URI')
 app.config["SECRET_KEY"] = os.getenv('SECRET_KEY')
 
-# Use MongoClient directly from pymongo
-client = MongoClient(app.config["MONGO_URI"])
-
-# Access the database
-db = client["db"]
-
 # Set up logging
 logger = logging.getLogger('flask_app')
-logger.setLevel(logging.DEBUG)  # Set the desired logging level
-# Create and add the MongoDB handler
-mongo_handler = MongoDBHandler(db.logs)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-mongo_handler.setFormatter(formatter)
-logger.addHandler(mongo_handler)
+# Every record is a MongoDB write, so debug lines are opt-in (LOG_LEVEL=DEBUG in .env)
+logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+# Under gunicorn a background thread batches records into MongoDB. Elsewhere, e.g. Zappa
+# on Lambda, threads are frozen between invocations, so each request writes its own batch
+LOG_IN_BACKGROUND = 'gunicorn' in sys.modules
+log_handler = add_mongo_handler(logger, db.logs, background=LOG_IN_BACKGROUND)
+
+if not LOG_IN_BACKGROUND:
+    @app.teardown_request
+    def flush_logs(exc):
+        log_handler.flush()
 
 MAX_FILE_SIZE = 1024 * 1024 * 400  # 400MB
 
+# Same variable and default as gunicorn.conf.py: each gevent worker serves up to this
+# many requests at once, and each may hold an S3 connection
+GUNICORN_WORKER_CONNECTIONS = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+S3_DELETE_BATCH_SIZE = 1000  # DeleteObjects accepts at most 1000 keys per call
+
+# Fixed per deployment, so read them once instead of on every request
+BUCKET_NAME = os.getenv('AWS_APP_STORAGE_BUCKET_NAME')
+BUCKET_URL = get_bucket_url()
+
+# Shared S3 client so every request reuses the same connection pool
+S3_CLIENT = boto3.client(
+    's3',
+    aws_access_key_id=os.getenv('AWS_APP_ACCESS_KEY_ID'),
+    aws_secret_access_key=os.getenv('AWS_APP_SECRET_ACCESS_KEY'),
+    region_name=os.getenv('AWS_APP_S3_REGION_NAME'),
+    config=Config(
+        max_pool_connections=max(50, GUNICORN_WORKER_CONNECTIONS),
+        tcp_keepalive=True,
+        retries={'mode': 'adaptive', 'max_attempts': 3},
+        connect_timeout=2,
+        read_timeout=10,
+        signature_version='s3v4'
+    )
+)
+
+FILES_UNIQUE_INDEX = 's3_key_1_user_1'
+# Set once the index has been seen, so each process only asks MongoDB until it exists
+files_unique_index_ready = False
+
+def has_files_unique_index():
+    global files_unique_index_ready
+    if not files_unique_index_ready:
+        files_unique_index_ready = FILES_UNIQUE_INDEX in db.files.index_information()
+    return files_unique_index_ready
+
+def find_duplicate_file_records():
+    # Uploads used to insert a new document every time, so older data can hold several
+    # per (s3_key, user). The first id of each group is the one to keep: a completed
+    # upload over an abandoned pending one, then the newest
+    return db.files.aggregate([
+        {'$addFields': {'complete': {'$eq': ['$upload_complete', 'complete']}}},
+        {'$sort': {'complete': -1, '_id': -1}},
+        {'$group': {'_id': {'s3_key': '$s3_key', 'user': '$user'}, 'ids': {'$push': '$_id'}}},
+        {'$match': {'ids.1': {'$exists': True}}}
+    ], allowDiskUse=True)
+
+def ensure_indexes():
+    # One document per stored object; rename_file relies on this to detect name collisions.
+    # Fails if duplicates exist; review and remove them with dedupe-files first
+    db.files.create_index([('s3_key', 1), ('user', 1)], unique=True, name=FILES_UNIQUE_INDEX)
+    # Keeps the id branch of find_user_file's $or on an index too
+    db.files.create_index([('user', 1), ('id', 1)])
+
+# Run once per deployment rather than on every worker start:
+#   flask --app app ensure-indexes   (or: zappa invoke dev 'app.ensure_indexes')
+@app.cli.command('ensure-indexes')
+def ensure_indexes_command():
+    ensure_indexes()
+    print("Indexes are up to date.")
+
+# Lists the duplicate file documents that block the unique index; nothing is
+# deleted unless --apply is given:  flask --app app dedupe-files [--apply]
+@app.cli.command('dedupe-files')
+@click.option('--apply', is_flag=True, help='Delete the listed documents.')
+def dedupe_files_command(apply):
+    removed = 0
+    for duplicate in find_duplicate_file_records():
+        keep_id, remove_ids = duplicate['ids'][0], duplicate['ids'][1:]
+        print(f"{duplicate['_id']['s3_key']} (user {duplicate['_id']['user']}): keep {keep_id}, remove {', '.join(map(str, remove_ids))}")
+        if apply:
+            removed += db.files.delete_many({'_id': {'$in': remove_ids}}).deleted_count
+            logger.info("Removed duplicate file documents %s, kept %s", remove_ids, keep_id)
+    print(f"Removed {removed} documents." if apply else "Dry run; rerun with --apply to delete the listed documents.")
+
 # Handle the OPTIONS request manually to avoid 404 errors
 @app.before_request
 def handle_options_request():
@@ -65,22 +148,26 @@ def register():
         return jsonify({"error": "Missing email or password"}), 400
 
     # Check if user with the same email already exists
-    if db.users.find_one({"email": email}):
+    if db.users.find_one({"email": email}, {"_id": 1}):
         return jsonify({"error": "Email already registered"}), 409
 
     # Hash the password
     hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
 
-    # Insert new user into the database
+    # Insert new user into the database; the id is chosen up front so the S3 prefix
+    # derived from it is stored in the same write
+    user_id = ObjectId()
     db.users.insert_one({
+        "_id": user_id,
         "email": email,
-        "password": hashed_password
+        "password": hashed_password,
+        "username_prefix": get_username_prefix(user_id)
     })
 
     # Generate JWT token
     token = jwt.encode({
         'email': email,
-        'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)
+        'exp': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=24)
     }, app.config['SECRET_KEY'], algorithm='HS256')
 
     # Return success message along with the token
@@ -110,7 +197,7 @@ def login():
     # logger.debug(f"=== Trying to find {email}====")
 
     # Find user by email
-    user = db.users.find_one({"email": email})
+    user = db.users.find_one({"email": email}, {"password": 1})
 
     # logger.debug(f"=== Checking password===")
 
@@ -119,7 +206,7 @@ def login():
         # Generate a token
         token = jwt.encode({
             'email': email,
-            'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)
+            'exp': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=24)
         }, app.config['SECRET_KEY'], algorithm='HS256')
 
         # Return login success message along with the token
@@ -128,114 +215,172 @@ def login():
         return jsonify({"error": "Invalid credentials"}), 401
 
 
+def build_file_list(items):
+    files = []
+    for item in items:
+        if 'Key' not in item:
+            continue
+        file_key = item['Key']
+        # Everything in the entry comes from the S3 listing itself, so no
+        # per-file MongoDB lookup is needed
+        files.append({
+        'file_name': file_key.rpartition('/')[2],
+        'simple_url': BUCKET_URL + file_key,
+        'metadata': {"tier": item['StorageClass'].lower(), "size": item['Size']},
+        'upload_complete': 'complete',
+        "last_modified": item['LastModified'],
+        'id': file_key,
+        "s3_key": file_key
+        })
+    return files
+
+def conditional_json(payload):
+    # Clients poll the listing; an unchanged body is answered with 304 and no payload
+    response = jsonify(payload)
+    response.add_etag()
+    return response.make_conditional(request)
+
 @app.route('/api/files/', methods=['GET'])
 @token_required
 def list_files(current_user):
     try:
     
-        logger.debug(f"Listing files for {current_user['email']}")
-        # Setup S3 client
-        logger.debug(f"Setting up S3 client")
-        # logger.debug(f"App Access key: {os.getenv('AWS_APP_ACCESS_KEY_ID')}")
-        s3 = boto3.client('s3',
-                        aws_access_key_id=os.getenv('AWS_APP_ACCESS_KEY_ID'),
-                        aws_secret_access_key=os.getenv('AWS_APP_SECRET_ACCESS_KEY'),
-                        region_name=os.getenv('AWS_APP_S3_REGION_NAME'))
+        logger.debug("Listing files for %s", current_user['email'])
         
-        prefix = current_user['email'].split('.com')[0].replace("@", "-")
+        prefix = current_user['username_prefix']
 
-        # List objects in the S3 bucket with the user's prefix
-        response = s3.list_objects_v2(Bucket=os.getenv('AWS_APP_STORAGE_BUCKET_NAME'), Prefix=f"{prefix}/")
-        
-        files = []
-        for item in response.get('Contents', []):
-            if 'Key' not in item:
-                continue
-            # print(item)
-            file_key = item['Key']
-            file_record = db.files.find_one({"s3_key": file_key, "upload_complete": "complete"})
-            
-            files.append({
-            'file_name': file_key.split("/")[-1],
-            'simple_url': get_bucket_url() + file_key,
-            'metadata': {"tier": item['StorageClass'].lower(), "size": item['Size']},
-            'upload_complete': 'complete',
-            "last_modified": item['LastModified'],
-            'id': file_key,
-            "s3_key": file_key
-            })
-            # else:
-            #     files.append({
-            #         'file_name': file_key.split("/")[-1],
-            #         'simple_url': get_bucket_url() + file_key,
-            #         'metadata': {"tier": item['StorageClass'].lower(), "size": item['Size']},
-            #         'upload_complete': file_record['upload_complete'],
-            #         'id': 'complete',
-            #         "last_modified": item['LastModified'],
-            #         "s3_key": file_key
-            #     })
-        files = sorted(files, key=lambda x: x['last_modified'], reverse=True)
-            
-        
-        return jsonify(files), 200
+        if 'page' in request.args:
+            return jsonify({'error': 'page is not supported; use per_page with the returned next_cursor.'}), 400
+
+        per_page = request.args.get('per_page')
+        if per_page is None:
+            # Without per_page the whole listing is returned newest first, as before; a
+            # single list_objects_v2 call stops at 1000 keys, so walk every page
+            paginator = S3_CLIENT.get_paginator('list_objects_v2')
+            pages = paginator.paginate(Bucket=BUCKET_NAME, Prefix=f"{prefix}/")
+            files = build_file_list(item for page in pages for item in page.get('Contents', []))
+            files.sort(key=lambda x: x['last_modified'], reverse=True)
+            return conditional_json(files)
+
+        try:
+            per_page = int(per_page)
+        except ValueError:
+            per_page = 0
+        if not 1 <= per_page <= 1000:
+            return jsonify({'error': 'per_page must be an integer between 1 and 1000.'}), 400
+
+        # The cursor is S3's own continuation token, so S3 resumes the listing server-side
+        # and page N costs the same as page 1. Bucket and Prefix always come from the
+        # server, never from the cursor
+        params = {'Bucket': BUCKET_NAME, 'Prefix': f"{prefix}/", 'MaxKeys': per_page}
+        cursor = request.args.get('cursor')
+        if cursor:
+            try:
+                params['ContinuationToken'] = base64.urlsafe_b64decode(cursor.encode()).decode()
+            except ValueError:
+                return jsonify({'error': 'Invalid cursor.'}), 400
+
+        try:
+            response = S3_CLIENT.list_objects_v2(**params)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'InvalidArgument':
+                return jsonify({'error': 'Invalid cursor.'}), 400
+            raise
+        # Pages follow S3's key order; sorting each page by date on its own would
+        # interleave dates across pages
+        files = build_file_list(response.get('Contents', []))
+
+        next_cursor = None
+        if response.get('IsTruncated'):
+            next_cursor = base64.urlsafe_b64encode(response['NextContinuationToken'].encode()).decode()
+
+        return conditional_json({'files': files, 'next_cursor': next_cursor})
+    except (ConnectTimeoutError, ReadTimeoutError) as e:
+        # S3 is slow or unreachable; let the client retry instead of reporting a server fault
+        logger.warning("Timed out listing files: %s", e)
+        return jsonify({"error": "Storage is temporarily unavailable, please retry."}), 503
     except Exception as e:
-        logger.exception(f"Error listing files: {str(e)}")
+        logger.exception("Error listing files: %s", e)
         # print("Error listing files: ", str(e))
         return jsonify({"error": str(e)}), 500
     
 
+ARCHIVED_STORAGE_CLASSES = {'GLACIER', 'DEEP_ARCHIVE'}
+RESTORE_IN_PROGRESS = {'message': 'File is being restored. Try again later.'}
+
+def get_restore_state(head_response):
+    # 'archived', 'restoring' or 'available', from a single head_object response
+    if head_response.get('StorageClass', 'STANDARD') not in ARCHIVED_STORAGE_CLASSES:
+        return 'available'
+    restore = head_response.get('Restore')
+    if not restore:
+        return 'archived'
+    if 'ongoing-request="true"' in restore:
+        return 'restoring'
+    return 'available'
+
+def start_restore(s3_key):
+    try:
+        S3_CLIENT.restore_object(
+            Bucket=BUCKET_NAME,
+            Key=s3_key,
+            RestoreRequest={'Days': 1, 'GlacierJobParameters': {'Tier': 'Standard'}}
+        )
+        logger.debug("Restore request initiated for %s", s3_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'RestoreAlreadyInProgress':
+            raise
+    return jsonify(RESTORE_IN_PROGRESS), 202
+
+def restore_in_progress(s3_key):
+    return jsonify(RESTORE_IN_PROGRESS), 202
+
+RESTORE_TRANSITIONS = {
+    'archived': start_restore,
+    'restoring': restore_in_progress,
+}
+
+def restore_if_archived(head_response, s3_key):
+    # Returns the response to send while the object is in Glacier, or None once it is readable
+    handler = RESTORE_TRANSITIONS.get(get_restore_state(head_response))
+    return handler(s3_key) if handler else None
+
+def find_user_file(current_user, file_identifier):
+    # Files are addressed by id or MongoDB _id; one $or query covers both
+    candidates = [{"id": file_identifier}]
+    if ObjectId.is_valid(file_identifier):
+        candidates.append({"_id": ObjectId(file_identifier)})
+    return db.files.find_one(
+        {"user": str(current_user['_id']), "$or": candidates},
+        {"s3_key": 1, "file_name": 1, "metadata": 1}
+    )
+
 @app.route('/api/files/<file_id>/download_file/', methods=['GET'])
 @token_required
 def download_file(current_user, file_id):
     # Check if the file exists and belongs to the current user
-    logger.debug(f"Downloading file {file_id} for {current_user['email']}")
-    logger.debug(f"Finding file from db")
-    file_record = db.files.find_one({"id": file_id, "user": str(current_user['_id'])})
+    logger.debug("Downloading file %s for %s", file_id, current_user['email'])
+    logger.debug("Finding file from db")
+    file_record = find_user_file(current_user, file_id)
     if not file_record:
         return jsonify({'error': 'File not found'}), 404
 
-    s3 = boto3.client('s3',
-                      aws_access_key_id=os.getenv('AWS_APP_ACCESS_KEY_ID'),
-                      aws_secret_access_key=os.getenv('AWS_APP_SECRET_ACCESS_KEY'),
-                      region_name=os.getenv('AWS_APP_S3_REGION_NAME'))
-
     try:
-        logger.debug(f"Requesting S3")
-        head_response = s3.head_object(Bucket=os.getenv('AWS_APP_STORAGE_BUCKET_NAME'), Key=file_record['s3_key'])
-        storage_class = head_response.get('StorageClass', 'STANDARD')
-        # print("storage_class => ", storage_class)
-        logger.debug(f"Storage class: {storage_class}")
-
-        if storage_class in ['GLACIER', 'DEEP_ARCHIVE']:
-            # print("head response => ", head_response)
-            if 'Restore' not in head_response or 'ongoing-request="true"' in head_response['Restore'] or 'ongoing-request="true"' in head_response['x-amz-restore']:
-                try:
-                    s3_response = s3.restore_object(
-                        Bucket=os.getenv('AWS_APP_STORAGE_BUCKET_NAME'),
-                        Key=file_record['s3_key'],
-                        RestoreRequest={'Days': 1, 'GlacierJobParameters': {'Tier': 'Standard'}}
-                    )
-                    logger.debug("s3_response while downloading=> ", s3_response)
-                    # db.files.update_one({"id": file_id}, {"$set": {"metadata.tier": "unarchiving"}})
-
-                    return jsonify({'message': 'File is being restored. Try again later.'}), 202
-    
-                except Exception as e:
-                    if 'RestoreAlreadyInProgress' in str(e):
-                        return jsonify({'message': 'File is being restored. Try again later.'}), 203
-                    logger.exception(f"Error restoring file: {str(e)}")
-                    return jsonify({'error': str(e)}), 500
-                    
-    
-        logger.debug(f"Getting file from S3 to return")
-        file_obj = s3.get_object(Bucket=os.getenv('AWS_APP_STORAGE_BUCKET_NAME'), Key=file_record['s3_key'])
+        logger.debug("Requesting S3")
+        head_response = S3_CLIENT.head_object(Bucket=BUCKET_NAME, Key=file_record['s3_key'])
+        restore_response = restore_if_archived(head_response, file_record['s3_key'])
+        if restore_response:
+            return restore_response
+
+        logger.debug("Getting file from S3 to return")
+        file_obj = S3_CLIENT.get_object(Bucket=BUCKET_NAME, Key=file_record['s3_key'])
         file_data = file_obj['Body'].read()
 
         # Return the file
         return Response(file_data, mimetype=file_record['metadata']['content_type'],
                         headers={"Content-Disposition": f"attachment; filename={file_record['file_name']}"})
     except Exception as e:
-        logger.exception(f"Error downloading file: {str(e)}")
+        logger.exception("Error downloading file: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
@@ -243,92 +388,68 @@ def download_file(current_user, file_id):
 @app.route('/api/files/<file_id>/download_presigned_url/', methods=['GET'])
 @token_required
 def download_presigned_url(current_user, file_id):
-    logger.debug(f"Generating presigned URL for file {file_id} for user {current_user['email']}")
+    logger.debug("Generating presigned URL for file %s for user %s", file_id, current_user['email'])
 
     # Check if the file exists and belongs to the current user
-    file_record = db.files.find_one({"id": file_id, "user": str(current_user['_id'])})
+    file_record = find_user_file(current_user, file_id)
     if not file_record:
         return jsonify({'error': 'File not found'}), 404
 
-    s3 = boto3.client('s3',
-                      aws_access_key_id=os.getenv('AWS_APP_ACCESS_KEY_ID'),
-                      aws_secret_access_key=os.getenv('AWS_APP_SECRET_ACCESS_KEY'),
-                      region_name=os.getenv('AWS_APP_S3_REGION_NAME'))
-
     try:
-        # Check the storage class
-        head_response = s3.head_object(Bucket=os.getenv('AWS_APP_STORAGE_BUCKET_NAME'), Key=file_record['s3_key'])
-        storage_class = head_response.get('StorageClass', 'STANDARD')
-        logger.debug(f"Storage class: {storage_class}")
-
-        if storage_class in ['GLACIER', 'DEEP_ARCHIVE']:
-            # Check if the object is already being restored
-            restore_status = head_response.get('Restore', '')
-            if 'ongoing-request="true"' in restore_status or 'x-amz-restore' in head_response and 'ongoing-request="true"' in head_response['x-amz-restore']:
-                return jsonify({'message': 'File is being restored. Try again later.'}), 202
-
-            # Initiate restoration
-            s3.restore_object(
-                Bucket=os.getenv('AWS_APP_STORAGE_BUCKET_NAME'),
-                Key=file_record['s3_key'],
-                RestoreRequest={'Days': 1, 'GlacierJobParameters': {'Tier': 'Standard'}}
-            )
-            logger.debug("Restore request initiated.")
-            return jsonify({'message': 'File is being restored. Try again later.'}), 202
+        # Archived objects have to be restored before they can be downloaded
+        head_response = S3_CLIENT.head_object(Bucket=BUCKET_NAME, Key=file_record['s3_key'])
+        restore_response = restore_if_archived(head_response, file_record['s3_key'])
+        if restore_response:
+            return restore_response
 
         # Generate a presigned URL
-        presigned_url = s3.generate_presigned_url(
+        presigned_url = S3_CLIENT.generate_presigned_url(
             'get_object',
             Params={
-                'Bucket': os.getenv('AWS_APP_STORAGE_BUCKET_NAME'),
+                'Bucket': BUCKET_NAME,
                 'Key': file_record['s3_key']
             },
             ExpiresIn=3600  # URL expires in 1 hour
         )
 
-        logger.debug(f"Presigned URL generated: {presigned_url}")
+        logger.debug("Presigned URL generated: %s", presigned_url)
 
         return jsonify({'presigned_url': presigned_url, 'file_name': file_record['file_name']}), 200
 
     except Exception as e:
-        logger.exception(f"Error generating presigned URL: {str(e)}")
+        logger.exception("Error generating presigned URL: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/files/<file_id>/refresh', methods=['GET'])
 @token_required
 def refresh_file_metadata(current_user, file_id):
-    logger.debug(f"Refreshing metadata for file {file_id} for {current_user['email']}")
-    file_record = db.files.find_one({"_id": file_id, "user": current_user['_id']})
+    logger.debug("Refreshing metadata for file %s for %s", file_id, current_user['email'])
+    file_record = find_user_file(current_user, file_id)
     if not file_record:
         return jsonify({'error': 'File not found'}), 404
 
-    s3 = boto3.client('s3',
-                      aws_access_key_id=os.getenv('AWS_APP_ACCESS_KEY_ID'),
-                      aws_secret_access_key=os.getenv('AWS_APP_SECRET_ACCESS_KEY'),
-                      region_name=os.getenv('AWS_APP_S3_REGION_NAME'))
-
     try:
-        head_response = s3.head_object(Bucket=os.getenv('AWS_APP_STORAGE_BUCKET_NAME'), Key=file_record['s3_key'])
+        head_response = S3_CLIENT.head_object(Bucket=BUCKET_NAME, Key=file_record['s3_key'])
         storage_class = head_response.get('StorageClass', 'STANDARD')
 
         # Update the storage class in the metadata
         if storage_class == 'STANDARD':
             file_record['metadata']['tier'] = 'standard'
-        elif storage_class in ['GLACIER', 'DEEP_ARCHIVE']:
+        elif storage_class in ARCHIVED_STORAGE_CLASSES:
             file_record['metadata']['tier'] = 'glacier' if 'Restore' not in head_response else 'unarchiving'
 
-        db.files.update_one({"id": file_id}, {"$set": {"metadata": file_record['metadata']}})
+        db.files.update_one({"_id": file_record['_id']}, {"$set": {"metadata": file_record['metadata']}})
 
         return jsonify({'message': 'Metadata refreshed', 'metadata': file_record['metadata']}), 200
 
     except Exception as e:
-        logger.exception(f"Error refreshing metadata: {str(e)}")
+        logger.exception("Error refreshing metadata: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
 
 def generate_simple_url(s3_key):
-    s3_url = f"https://{os.getenv('AWS_APP_STORAGE_BUCKET_NAME')}.s3.amazonaws.com/{s3_key}"
+    s3_url = BUCKET_URL + s3_key
     simple_url = requests.get(f"https://ks0bm06q4a.execute-api.us-west-2.amazonaws.com/dev?long_url={s3_url}").json()
     return "https://simple-url.skdev.one/"+simple_url['short_url']
 
@@ -348,7 +469,7 @@ def upload_file(current_user):
         file_size = data.get('file_size')
 
         if file_size > MAX_FILE_SIZE:
-            logger.debug(f"File size exceeds the limit of 400MB")
+            logger.debug("File size exceeds the limit of 400MB")
             return jsonify({'error': 'File size exceeds the limit of 400MB'}), 400
 
         if not file_name or not content_type:
@@ -357,28 +478,16 @@ def upload_file(current_user):
         # Ensure filename is secure
         filename = secure_filename(file_name)
 
-        # Generate username from email
-        email_parts = current_user['email'].split('@')
-        username = f"{email_parts[0]}-{email_parts[1].split('.')[0]}"
-
         # Generate S3 key
-        s3_key = f"{username}/{filename}"
+        s3_key = f"{current_user['username_prefix']}/{filename}"
 
-        logger.debug(f"Generating presigned URL for {filename} (Tier: {tier})")
-
-        # Initialize S3 client
-        s3 = boto3.client(
-            's3',
-            aws_access_key_id=os.getenv('AWS_APP_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_APP_SECRET_ACCESS_KEY'),
-            region_name=os.getenv('AWS_APP_S3_REGION_NAME')
-        )
+        logger.debug("Generating presigned URL for %s (Tier: %s)", filename, tier)
 
         # Generate presigned URL
-        presigned_url = s3.generate_presigned_url(
+        presigned_url = S3_CLIENT.generate_presigned_url(
             'put_object',
             Params={
-                'Bucket': os.getenv('AWS_APP_STORAGE_BUCKET_NAME'),
+                'Bucket': BUCKET_NAME,
                 'Key': s3_key,
                 'ContentType': content_type,
                 'StorageClass': 'GLACIER' if tier == 'glacier' else 'STANDARD',
@@ -396,7 +505,7 @@ def upload_file(current_user):
         }), 200
 
     except Exception as e:
-        logger.exception(f"Error generating presigned URL: {str(e)}")
+        logger.exception("Error generating presigned URL: %s", e)
         return jsonify({'error': 'Failed to generate presigned URL.'}), 500
 
 def store_file_metadata(current_user, filename, s3_key, content_type, tier, upload_complete=True):
@@ -414,13 +523,17 @@ def store_file_metadata(current_user, filename, s3_key, content_type, tier, uplo
         # Add other necessary fields as required
     }
 
-    # Insert into the database (MongoDB)
-    db.files.insert_one(file_metadata)
+    # Upsert so re-uploading the same file name doesn't trip the unique (s3_key, user) index
+    db.files.update_one(
+        {'s3_key': s3_key, 'user': file_metadata['user']},
+        {'$set': file_metadata},
+        upsert=True
+    )
 
 @app.route('/api/files/confirm_upload/', methods=['POST'])
 @token_required
 def confirm_upload(current_user):
-    data = request.get_json()
+    data = request.get_json(cache=False)
     s3_key = data.get('s3_key')
 
     if not s3_key:
@@ -442,12 +555,8 @@ def confirm_upload(current_user):
 @app.route('/api/files/presign/', methods=['GET'])
 @token_required
 def generate_presigned_url(current_user):
-    logger.debug(f"Generating pre-signed URL for {current_user['email']}")
-    # Initialize S3 client
-    s3_client = boto3.client('s3',
-                             aws_access_key_id=os.getenv('AWS_APP_ACCESS_KEY_ID'),
-                             aws_secret_access_key=os.getenv('AWS_APP_SECRET_ACCESS_KEY'),
-                             region_name=os.getenv('AWS_APP_S3_REGION_NAME'))
+    now = datetime.datetime.now(datetime.timezone.utc)
+    logger.debug("Generating pre-signed URL for %s", current_user['email'])
 
     # Get file name from query parameters
     file_name = request.args.get('file_name')
@@ -455,25 +564,19 @@ def generate_presigned_url(current_user):
         return jsonify({"error": "File name parameter is missing."}), 400
 
     # Optionally get metadata from query params
-    logger.debug(f"Getting metadata from query params: {request.args}")
+    logger.debug("Getting metadata from query params: %s", request.args)
     file_metadata = request.args.get('metadata', {"tier": "standard"})
 
-    # Generate a username-based key from the current user's email
-    username = current_user['email'].split('@')[0] + "-" + current_user['email'].split('@')[1].split('.')[0]
-
     # Generate the S3 key for the file
-    s3_key = f"{username}/{file_name}"
-
-    # Get the bucket name from environment variables
-    bucket_name = os.getenv('AWS_APP_STORAGE_BUCKET_NAME')
+    s3_key = f"{current_user['username_prefix']}/{file_name}"
 
     try:
         # Generate a pre-signed URL for PUT operation
-        presigned_url = s3_client.generate_presigned_url('put_object',
-                                                         Params={'Bucket': bucket_name, 'Key': s3_key},
+        presigned_url = S3_CLIENT.generate_presigned_url('put_object',
+                                                         Params={'Bucket': BUCKET_NAME, 'Key': s3_key},
                                                          ExpiresIn=3600)  # URL expires in 1 hour
     except Exception as e:
-        logger.exception(f"Error generating pre-signed URL: {str(e)}")
+        logger.exception("Error generating pre-signed URL: %s", e)
         return jsonify({'error': str(e)}), 500
 
     # Create a temporary file record in MongoDB
@@ -484,18 +587,23 @@ def generate_presigned_url(current_user):
         'metadata': file_metadata,
         'simple_url': '',  # Placeholder for now
         'upload_complete': 'pending',  # Track the completion status
-        'created_at': datetime.datetime.utcnow(),
+        'created_at': now,
         "id": s3_key.replace("/", "-")
     }
 
-    # Insert the temporary record in the files collection
-    temp_file_id = db.files.insert_one(file_record).inserted_id
+    # Upsert the temporary record without waiting for the server ack; the
+    # response only needs the client-side id, and confirm_upload finalizes it
+    db.files.with_options(write_concern=WriteConcern(w=0)).update_one(
+        {'s3_key': s3_key, 'user': file_record['user']},
+        {'$set': file_record},
+        upsert=True
+    )
 
     # Return the pre-signed URL and temporary file ID
     return jsonify({
         "presigned_url": presigned_url,
         "file_name": s3_key,
-        "id": s3_key.replace("/", "-")
+        "id": file_record["id"]
     }), 200
 
 @app.route('/api/logs/', methods=['GET'])
@@ -503,7 +611,9 @@ def generate_presigned_url(current_user):
 def get_logs():
     try:
         # Fetch the latest 100 logs, sorted by timestamp descending
-        logs_cursor = db.logs.find().sort("timestamp", -1).limit(100)
+        logs_cursor = db.logs.find(
+            {}, {"_id": 0, "timestamp": 1, "level": 1, "message": 1, "module": 1, "funcName": 1, "lineno": 1}
+        ).sort("timestamp", -1).limit(100)
         logs = []
         for log in logs_cursor:
             logs.append({
@@ -517,72 +627,114 @@ def get_logs():
         logger.debug("Logs retrieved successfully")
         return jsonify({"logs": logs}), 200
     except Exception as e:
-        logger.error(f"Error fetching logs: {str(e)}", exc_info=True)
+        logger.error("Error fetching logs: %s", e, exc_info=True)
         return jsonify({"error": "Internal server error"}), 500
 
 
+def delete_s3_objects(s3_keys):
+    # Returns {s3_key: error} for the keys S3 could not delete; quiet mode only reports those
+    failed = {}
+    for start in range(0, len(s3_keys), S3_DELETE_BATCH_SIZE):
+        response = S3_CLIENT.delete_objects(
+            Bucket=BUCKET_NAME,
+            Delete={'Objects': [{'Key': s3_key} for s3_key in s3_keys[start:start + S3_DELETE_BATCH_SIZE]], 'Quiet': True}
+        )
+        for error in response.get('Errors', []):
+            failed[error['Key']] = error.get('Message', error.get('Code'))
+    return failed
+
+def owns_key(current_user, s3_key):
+    # Legacy objects have no metadata to check against, so ownership comes from the key prefix
+    return s3_key.startswith(f"{current_user['username_prefix']}/")
+
+def delete_files_bulk(current_user, s3_keys):
+    logger.debug("Attempting to delete %s files for user: %s", len(s3_keys), current_user['email'])
+
+    rejected = [s3_key for s3_key in s3_keys if not owns_key(current_user, s3_key)]
+    s3_keys = [s3_key for s3_key in s3_keys if owns_key(current_user, s3_key)]
+    if rejected:
+        logger.warning("User %s tried to delete %s files outside their prefix", current_user['email'], len(rejected))
+    if not s3_keys:
+        return jsonify({'error': 'File not found or unauthorized.', 'rejected': rejected}), 404
+
+    # Drop the metadata first so a failure here leaves everything intact for a retry
+    try:
+        result = db.files.delete_many({'s3_key': {'$in': s3_keys}, 'user': str(current_user['_id'])})
+        logger.debug("Deleted %s file metadata documents from MongoDB", result.deleted_count)
+    except Exception as e:
+        logger.exception("Error deleting file metadata from MongoDB: %s", e)
+        return jsonify({'error': 'Failed to delete file metadata.'}), 500
+
+    # The listing reads S3 directly, so the objects must be gone before responding
+    try:
+        failed = delete_s3_objects(s3_keys)
+    except Exception as e:
+        logger.exception("Error deleting files from S3: %s", e)
+        return jsonify({'error': 'Failed to delete files from storage.'}), 500
+
+    if failed:
+        logger.error("S3 failed to delete %s of %s files", len(failed), len(s3_keys))
+
+    # Report status as a key list plus a key -> error map rather than a dict per key
+    return jsonify({
+        'message': 'Files deleted successfully.' if not failed else 'Some files could not be deleted.',
+        'deleted': [s3_key for s3_key in s3_keys if s3_key not in failed],
+        'failed': failed,
+        'rejected': rejected,
+        'db_deleted_count': result.deleted_count
+    }), 200
+
 # DELETE
 @app.route('/api/files/', methods=['DELETE'])
 @token_required
 def delete_file(current_user):
     try:
-        data = request.get_json()
+        data = request.get_json(cache=False)
         if not data:
             return jsonify({'error': 'Invalid JSON payload.'}), 400
+
+        s3_keys = data.get('s3_keys')
+        if s3_keys is not None:
+            if not isinstance(s3_keys, list) or not s3_keys or not all(isinstance(k, str) and k for k in s3_keys):
+                return jsonify({'error': 's3_keys must be a non-empty list of keys.'}), 400
+            # Drop duplicate keys so each object is only deleted once
+            return delete_files_bulk(current_user, list(dict.fromkeys(s3_keys)))
+
         s3_key = data.get('s3_key')
         if not s3_key:
             return jsonify({'error': 's3_key is required.'}), 400
         
-        logger.debug(f"Attempting to delete file with s3 key: {s3_key} for user: {current_user['email']}")
-
-
-        # Fetch the file document from MongoDB
-        file_doc = db.files.find_one({'s3_key': s3_key, 'user': str(current_user['_id'])})
-
-        if not file_doc:
-            logger.error(f"File not found or unauthorized for ID: {s3_key}")
-            # return jsonify({'error': 'File not found or unauthorized.'}), 404
-
-        logger.info(f"Deleting file with ID: {s3_key} for user: {current_user['email']} via S3")
-        if file_doc:
-            s3_key = file_doc.get('s3_key')
-        else:
-            s3_key = s3_key
-
-        if not s3_key:
-            return jsonify({'error': 'Invalid file metadata.'}), 400
+        logger.debug("Attempting to delete file with s3 key: %s for user: %s", s3_key, current_user['email'])
 
-        # Initialize S3 client
-        s3 = boto3.client(
-            's3',
-            aws_access_key_id=os.getenv('AWS_APP_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_APP_SECRET_ACCESS_KEY'),
-            region_name=os.getenv('AWS_APP_S3_REGION_NAME')
-        )
+        if not owns_key(current_user, s3_key):
+            logger.warning("User %s tried to delete %s outside their prefix", current_user['email'], s3_key)
+            return jsonify({'error': 'File not found or unauthorized.'}), 404
 
-        # Delete the file from S3
+        # Delete the file metadata first so a failure here leaves everything intact for a retry
         try:
-            s3.delete_object(Bucket=os.getenv('AWS_APP_STORAGE_BUCKET_NAME'), Key=s3_key)
-            logger.debug(f"Deleted file from S3: {s3_key}")
+            result = db.files.delete_one({'s3_key': s3_key, 'user': str(current_user['_id'])})
         except Exception as e:
-            logger.exception(f"Error deleting file from S3: {str(e)}")
-            return jsonify({'error': 'Failed to delete file from storage.'}), 500
+            logger.exception("Error deleting file metadata from MongoDB: %s", e)
+            return jsonify({'error': 'Failed to delete file metadata.'}), 500
 
-        # Delete the file metadata from MongoDB
+        # Objects without metadata are still listed from S3, so delete those too
+        logger.info("Deleting file with ID: %s for user: %s via S3", s3_key, current_user['email'])
         try:
-            result = db.files.delete_one({'s3_key': s3_key, 'user': str(current_user['_id'])})
-            if result.deleted_count == 0:
-                logger.error(f"File metadata not found for ID: {s3_key}")
-                return jsonify({'error': 'File metadata not found in db.'}), 200
-            logger.debug(f"Deleted file metadata from MongoDB for ID: {s3_key}")
+            S3_CLIENT.delete_object(Bucket=BUCKET_NAME, Key=s3_key)
+            logger.debug("Deleted file from S3: %s", s3_key)
         except Exception as e:
-            logger.exception(f"Error deleting file metadata from MongoDB: {str(e)}")
-            return jsonify({'error': 'Failed to delete file metadata.'}), 200
+            logger.exception("Error deleting file from S3: %s", e)
+            return jsonify({'error': 'Failed to delete file from storage.'}), 500
+
+        if result.deleted_count == 0:
+            logger.error("File metadata not found for ID: %s", s3_key)
+            return jsonify({'error': 'File metadata not found in db.'}), 200
+        logger.debug("Deleted file metadata from MongoDB for ID: %s", s3_key)
 
         return jsonify({'message': 'File deleted successfully.'}), 200
 
     except Exception as e:
-        logger.exception(f"Unexpected error during file deletion: {str(e)}")
+        logger.exception("Unexpected error during file deletion: %s", e)
         print("Unexpected error during file deletion: ", str(e))
         return jsonify({'error': 'An unexpected error occurred.'}), 500
 
@@ -590,7 +742,7 @@ def delete_file(current_user):
 @token_required
 def rename_file(current_user):
     try:
-        data = request.get_json()
+        data = request.get_json(cache=False)
         if not data:
             return jsonify({'error': 'Invalid JSON payload.'}), 400
 
@@ -600,16 +752,15 @@ def rename_file(current_user):
         if not s3_key or not new_filename:
             return jsonify({'error': 's3_key and new_filename are required.'}), 400
 
-        logger.debug(f"User {current_user['email']} is attempting to rename file {s3_key} to {new_filename}")
+        logger.debug("User %s is attempting to rename file %s to %s", current_user['email'], s3_key, new_filename)
 
         # Fetch the file document from MongoDB
-        file_doc = db.files.find_one({'s3_key': s3_key, 'user': str(current_user['_id'])})
+        file_doc = db.files.find_one({'s3_key': s3_key, 'user': str(current_user['_id'])}, {'s3_key': 1, 'filename': 1})
 
         if not file_doc:
             return jsonify({'error': 'File not found or unauthorized.'}), 404
 
         # Extract current s3 key details
-        bucket_name = os.getenv('AWS_APP_STORAGE_BUCKET_NAME')
         current_key = file_doc.get('s3_key')
         if not current_key:
             return jsonify({'error': 'Invalid file metadata.'}), 400
@@ -619,76 +770,87 @@ def rename_file(current_user):
         # Adjust this logic if your keys include paths
         new_key = '/'.join(current_key.split('/')[:-1] + [new_filename])
 
-        # Initialize S3 client
-        s3 = boto3.client(
-            's3',
-            aws_access_key_id=os.getenv('AWS_APP_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_APP_SECRET_ACCESS_KEY'),
-            region_name=os.getenv('AWS_APP_S3_REGION_NAME')
-        )
+        if new_key == current_key:
+            return jsonify({'error': 'A file with the new filename already exists.'}), 409
+
+        # Without the unique index two metadata documents could claim the same key
+        if not has_files_unique_index():
+            logger.error("Refusing to rename: the %s index is missing; run ensure-indexes", FILES_UNIQUE_INDEX)
+            return jsonify({'error': 'Renaming is temporarily unavailable.'}), 503
 
-        # Check if the new key already exists to prevent overwriting
+        # Objects that only exist in S3 have no metadata for the index to catch,
+        # so check the bucket too before anything is overwritten
         try:
-            s3.head_object(Bucket=bucket_name, Key=new_key)
+            S3_CLIENT.head_object(Bucket=BUCKET_NAME, Key=new_key)
             return jsonify({'error': 'A file with the new filename already exists.'}), 409
-        except s3.exceptions.ClientError as e:
+        except ClientError as e:
             if e.response['Error']['Code'] != '404':
-                logger.exception(f"Error checking existence of new key: {str(e)}")
+                logger.exception("Error checking existence of new key: %s", e)
                 return jsonify({'error': 'Error checking file existence.'}), 500
             # If 404, the object does not exist, which is desired
 
+        # Claim the new key in MongoDB before touching S3; the unique (s3_key, user)
+        # index rejects a concurrent rename to the same name
+        try:
+            update_result = db.files.update_one(
+                {'_id': file_doc['_id']},
+                {'$set': {'s3_key': new_key, 'filename': new_filename}}
+            )
+        except DuplicateKeyError:
+            return jsonify({'error': 'A file with the new filename already exists.'}), 409
+        except Exception as e:
+            logger.exception("Error updating file metadata in MongoDB: %s", e)
+            return jsonify({'error': 'Failed to update file metadata.'}), 500
+
+        if update_result.modified_count == 0:
+            logger.error("Failed to update MongoDB document for file ID: %s", file_doc['_id'])
+            return jsonify({'error': 'Failed to update file metadata.'}), 500
+        logger.debug("Updated MongoDB document with new filename and s3_key for file ID: %s", file_doc['_id'])
+
+        def revert_metadata():
+            revert = {'$set': {'s3_key': current_key}}
+            if 'filename' in file_doc:
+                revert['$set']['filename'] = file_doc['filename']
+            else:
+                revert['$unset'] = {'filename': ''}
+            try:
+                db.files.update_one({'_id': file_doc['_id']}, revert)
+                logger.debug("Reverted MongoDB document for file ID: %s", file_doc['_id'])
+            except Exception as revert_e:
+                logger.exception("Error reverting file metadata: %s", revert_e)
+
         # Copy the object to the new key
         copy_source = {
-            'Bucket': bucket_name,
+            'Bucket': BUCKET_NAME,
             'Key': current_key
         }
 
         try:
-            s3.copy_object(CopySource=copy_source, Bucket=bucket_name, Key=new_key)
-            logger.debug(f"Copied file from {current_key} to {new_key} in S3.")
+            S3_CLIENT.copy_object(CopySource=copy_source, Bucket=BUCKET_NAME, Key=new_key)
+            logger.debug("Copied file from %s to %s in S3.", current_key, new_key)
         except Exception as e:
-            logger.exception(f"Error copying file in S3: {str(e)}")
+            logger.exception("Error copying file in S3: %s", e)
+            revert_metadata()
             return jsonify({'error': 'Failed to copy file in storage.'}), 500
 
         # Delete the original object from S3
         try:
-            s3.delete_object(Bucket=bucket_name, Key=current_key)
-            logger.debug(f"Deleted original file from S3: {current_key}")
+            S3_CLIENT.delete_object(Bucket=BUCKET_NAME, Key=current_key)
+            logger.debug("Deleted original file from S3: %s", current_key)
         except Exception as e:
-            logger.exception(f"Error deleting original file from S3: {str(e)}")
-            # Optionally, you might want to delete the copied file to maintain consistency
+            logger.exception("Error deleting original file from S3: %s", e)
             try:
-                s3.delete_object(Bucket=bucket_name, Key=new_key)
-                logger.debug(f"Deleted copied file due to failure: {new_key}")
+                S3_CLIENT.delete_object(Bucket=BUCKET_NAME, Key=new_key)
+                logger.debug("Deleted copied file due to failure: %s", new_key)
             except Exception as delete_e:
-                logger.exception(f"Error deleting copied file after failure: {str(delete_e)}")
+                logger.exception("Error deleting copied file after failure: %s", delete_e)
+            revert_metadata()
             return jsonify({'error': 'Failed to delete original file from storage.'}), 500
 
-        # Update the MongoDB document with the new s3_key and filename
-        try:
-            update_result = db.files.update_one(
-                {'_id': file_doc['_id']},
-                {'$set': {'s3_key': new_key, 'filename': new_filename}}
-            )
-            if update_result.modified_count == 0:
-                logger.error(f"Failed to update MongoDB document for file ID: {file_doc['_id']}")
-                return jsonify({'error': 'Failed to update file metadata.'}), 500
-            logger.debug(f"Updated MongoDB document with new filename and s3_key for file ID: {file_doc['_id']}")
-        except Exception as e:
-            logger.exception(f"Error updating file metadata in MongoDB: {str(e)}")
-            # Optionally, attempt to revert S3 changes to maintain consistency
-            try:
-                s3.copy_object(CopySource=copy_source, Bucket=bucket_name, Key=current_key)
-                s3.delete_object(Bucket=bucket_name, Key=new_key)
-                logger.debug("Reverted S3 changes due to MongoDB update failure.")
-            except Exception as revert_e:
-                logger.exception(f"Error reverting S3 changes: {str(revert_e)}")
-            return jsonify({'error': 'Failed to update file metadata.'}), 500
-
         return jsonify({'message': 'File renamed successfully.', 'new_s3_key': new_key, 'new_filename': new_filename}), 200
 
     except Exception as e:
-        logger.exception(f"Unexpected error during file rename: {str(e)}")
+        logger.exception("Unexpected error during file rename: %s", e)
         return jsonify({'error': 'An unexpected error occurred.'}), 500
 
 if __name__ == '__main__':
@@ -1,31 +1,18 @@
 import jwt
 from functools import wraps
 from flask import request, jsonify
-from pymongo import MongoClient
 import os
 from dotenv import load_dotenv
-from mongo_handler import MongoDBHandler
+from database import db
+from utils import get_legacy_username_prefix
 import logging
 
 load_dotenv()
 
-mongo_uri = os.getenv('MONGO_URI')
 secret_key = os.getenv('SECRET_KEY')
 
-
-client = MongoClient(mongo_uri)
-
-# Access the database
-db = client["db"]
-
-# Set up logging
-logger = logging.getLogger('flask_auth')
-logger.setLevel(logging.DEBUG)  # Set the desired logging level
-# Create and add the MongoDB handler
-mongo_handler = MongoDBHandler(db.logs)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-mongo_handler.setFormatter(formatter)
-logger.addHandler(mongo_handler)
+# Child of the app logger, so records go through its MongoDB handler
+logger = logging.getLogger('flask_app.auth')
 
 # Custom decorator for token-based authentication
 def token_required(f):
@@ -54,10 +41,14 @@ def token_required(f):
             # logger.debug(f"validating data with token and secret key {token} {secret_key}")
             data = jwt.decode(token, secret_key, algorithms=['HS256'])
             # logger.debug(f"Decoded token: {data}")
-            current_user = db.users.find_one({'email': data['email']})
+            current_user = db.users.find_one({'email': data['email']}, {'password': 0})
             # logger.debug(f"Current user: {current_user}")
             if not current_user:
                 return jsonify({'error': 'Invalid token!'}), 403
+            if 'username_prefix' not in current_user:
+                # Backfill accounts created before the prefix was stored at signup
+                current_user['username_prefix'] = get_legacy_username_prefix(current_user['email'])
+                db.users.update_one({'_id': current_user['_id']}, {'$set': {'username_prefix': current_user['username_prefix']}})
         except Exception as e:
             return jsonify({'error': 'Token is invalid!', 'message': str(e)}), 403
 
@@ -0,0 +1,12 @@
+import os
+from dotenv import load_dotenv
+from pymongo import MongoClient
+
+load_dotenv()
+
+# One MongoClient per process, shared by app.py and auth.py; connect lazily so
+# preloaded gunicorn workers open their own sockets after fork
+client = MongoClient(os.getenv('MONGO_URI'), connect=False)
+
+# Access the database
+db = client["db"]
@@ -0,0 +1,20 @@
+import multiprocessing
+import os
+
+# Run with: gunicorn app:gunicorn_app
+# Every endpoint mostly waits on S3 and MongoDB, so gevent workers let one
+# process overlap many requests instead of blocking a thread per request.
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+
+if worker_class == 'gevent':
+    # Patch before app.py imports boto3/pymongo so their sockets cooperate
+    from gevent import monkey
+    monkey.patch_all()
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5005')
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+# Import app.py once in the master so the botocore service models, the S3
+# client and the MongoDB client are shared copy-on-write across workers
+preload_app = True
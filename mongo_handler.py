@@ -1,21 +1,90 @@
+import atexit
 import logging
 import datetime
+import os
+import queue
+import sys
+import time
+import traceback
+from logging.handlers import QueueHandler, QueueListener
 
 class MongoDBHandler(logging.Handler):
-    def __init__(self, db_collection):
+    def __init__(self, db_collection, batch_size=100, flush_interval=1.0):
         super().__init__()
         self.collection = db_collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush = time.monotonic()
 
     def emit(self, record):
         try:
             log_entry = {
-                "timestamp": datetime.datetime.utcnow(),
+                "timestamp": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc),
                 "level": record.levelname,
                 "message": self.format(record),
                 "module": record.module,
                 "funcName": record.funcName,
                 "lineno": record.lineno
             }
-            self.collection.insert_one(log_entry)
+            self.buffer.append(log_entry)
+            if len(self.buffer) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush()
         except Exception:
             self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.buffer:
+                entries, self.buffer = self.buffer, []
+                self.collection.insert_many(entries, ordered=False)
+        except Exception:
+            if logging.raiseExceptions:
+                traceback.print_exc(file=sys.stderr)
+        finally:
+            self.last_flush = time.monotonic()
+            self.release()
+
+    def close(self):
+        self.flush()
+        super().close()
+
+class MongoDBQueueListener(QueueListener):
+    def dequeue(self, block):
+        # Wake up while idle so buffered entries still go out within flush_interval
+        while True:
+            try:
+                return self.queue.get(block, timeout=self.handlers[0].flush_interval)
+            except queue.Empty:
+                self.handlers[0].flush()
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+    def restart_in_child(self):
+        # Threads don't survive fork (gunicorn preload_app), and the parent's
+        # buffered entries are the parent's to write
+        self.handlers[0].buffer = []
+        self._thread = None
+        self.start()
+
+def add_mongo_handler(logger, db_collection, background=True):
+    handler = MongoDBHandler(db_collection)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    if not background:
+        # Records are buffered on the calling thread; the caller flushes them, e.g. after each request
+        logger.addHandler(handler)
+        atexit.register(handler.flush)
+        return handler
+
+    # Request threads only enqueue records; a background thread batches them into MongoDB
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(log_queue))
+
+    listener = MongoDBQueueListener(log_queue, handler)
+    listener.start()
+    os.register_at_fork(after_in_child=listener.restart_in_child)
+    atexit.register(listener.stop)
+    return handler
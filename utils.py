@@ -1,8 +1,21 @@
 import os
+from functools import lru_cache
 from dotenv import load_dotenv
 
 load_dotenv()
 
+@lru_cache(maxsize=1)
 def get_bucket_url():
 
-    return f"https://{os.getenv('AWS_APP_STORAGE_BUCKET_NAME')}.s3.amazonaws.com/"
\ No newline at end of file
+    return f"https://{os.getenv('AWS_APP_STORAGE_BUCKET_NAME')}.s3.amazonaws.com/"
+
+def get_username_prefix(user_id):
+    # S3 key prefix for a new user's files. The account's ObjectId is unique, has no '/'
+    # and no '-', so it can't nest under or match another account's prefix, legacy ones included
+    return str(user_id)
+
+def get_legacy_username_prefix(email):
+    # Prefix that accounts created before it was stored already have their objects
+    # under, e.g. "jane-gmail" for jane@gmail.com; only used to backfill those accounts
+    email_parts = email.split('@')
+    return f"{email_parts[0]}-{email_parts[1].split('.')[0]}"